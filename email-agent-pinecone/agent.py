@@ -4,7 +4,11 @@ Uses Bedrock Claude with tool use for intelligent email search.
 Two-stage retrieval: vector search → rerank for better relevance.
 """
 
+import json
+from hashlib import blake2b
+
 import boto3
+import orjson
 from config import REGION, LLM_MODEL
 from tools import semantic_search, search_by_sender
 
@@ -85,8 +89,57 @@ def execute_tool(tool_name: str, tool_input: dict) -> str:
         return f"Unknown tool: {tool_name}"
 
 
+def converse_stream(messages: list, system_prompt: str) -> tuple:
+    """
+    Call Bedrock ConverseStream, printing text as it arrives.
+    Returns (stop_reason, assistant_message) with the message reassembled
+    in the same shape as the non-streaming Converse output.
+    """
+    response = bedrock.converse_stream(
+        modelId=LLM_MODEL,
+        messages=messages,
+        system=[{"text": system_prompt}],
+        toolConfig={"tools": TOOLS}
+    )
+    
+    blocks = {}  # contentBlockIndex -> block being assembled
+    stop_reason = None
+    
+    for event in response['stream']:
+        if 'contentBlockStart' in event:
+            start = event['contentBlockStart']
+            tool_use = start['start'].get('toolUse')
+            if tool_use:
+                blocks[start['contentBlockIndex']] = {
+                    "toolUse": {"toolUseId": tool_use['toolUseId'], "name": tool_use['name']},
+                    "input": ""
+                }
+        
+        elif 'contentBlockDelta' in event:
+            delta_event = event['contentBlockDelta']
+            delta = delta_event['delta']
+            block = blocks.setdefault(delta_event['contentBlockIndex'], {"text": ""})
+            if 'text' in delta:
+                print(delta['text'], end="", flush=True)
+                block["text"] += delta['text']
+            elif 'toolUse' in delta:
+                block["input"] += delta['toolUse'].get('input', '')
+        
+        elif 'contentBlockStop' in event:
+            block = blocks.get(event['contentBlockStop']['contentBlockIndex'])
+            if block and 'toolUse' in block:
+                block['toolUse']['input'] = json.loads(block.pop('input') or '{}')
+        
+        elif 'messageStop' in event:
+            stop_reason = event['messageStop']['stopReason']
+    
+    # Bedrock rejects empty text blocks when the message is sent back
+    content = [blocks[i] for i in sorted(blocks) if blocks[i].get("text") != ""]
+    return stop_reason, {"role": "assistant", "content": content}
+
+
 def ask(question: str) -> str:
-    """Ask the email agent a question using Bedrock Converse API with tool use"""
+    """Ask the email agent a question using Bedrock ConverseStream API with tool use"""
     
     messages = [{"role": "user", "content": [{"text": question}]}]
     
@@ -109,20 +162,15 @@ Guidelines:
 - Be concise and helpful in your answers"""
 
     # Initial request
-    response = bedrock.converse(
-        modelId=LLM_MODEL,
-        messages=messages,
-        system=[{"text": system_prompt}],
-        toolConfig={"tools": TOOLS}
-    )
+    stop_reason, assistant_message = converse_stream(messages, system_prompt)
     
     # Handle tool use loop
     max_loops = 10
     loop_count = 0
+    tool_memo = {}
     
-    while response['stopReason'] == 'tool_use' and loop_count < max_loops:
+    while stop_reason == 'tool_use' and loop_count < max_loops:
         loop_count += 1
-        assistant_message = response['output']['message']
         messages.append(assistant_message)
         
         # Process tool calls
@@ -134,10 +182,18 @@ Guidelines:
                 tool_input = tool_use['input']
                 tool_id = tool_use['toolUseId']
                 
-                print(f"  → Using tool: {tool_name}")
+                print(f"\n  → Using tool: {tool_name}")
                 print(f"    Input: {tool_input}")
                 
-                result = execute_tool(tool_name, tool_input)
+                # Reuse results for repeated identical tool calls within this question
+                key = blake2b(
+                    tool_name.encode() + b"\0" + orjson.dumps(tool_input, option=orjson.OPT_SORT_KEYS),
+                    digest_size=16
+                ).hexdigest()
+                result = tool_memo.get(key)
+                if result is None:
+                    result = execute_tool(tool_name, tool_input)
+                    tool_memo[key] = result
                 print(f"    Result: {result[:300]}..." if len(result) > 300 else f"    Result: {result}")
                 
                 tool_results.append({
@@ -150,16 +206,10 @@ Guidelines:
         # Send tool results back
         messages.append({"role": "user", "content": tool_results})
         
-        response = bedrock.converse(
-            modelId=LLM_MODEL,
-            messages=messages,
-            system=[{"text": system_prompt}],
-            toolConfig={"tools": TOOLS}
-        )
+        stop_reason, assistant_message = converse_stream(messages, system_prompt)
     
     # Extract final text response
-    final_message = response['output']['message']
-    for block in final_message['content']:
+    for block in assistant_message['content']:
         if 'text' in block:
             return block['text']
     
@@ -181,8 +231,9 @@ def main():
             continue
         
         print()
-        answer = ask(question)
-        print(f"\nAnswer: {answer}")
+        # Answer text is streamed to stdout as it is generated
+        ask(question)
+        print()
 
 
 if __name__ == "__main__":
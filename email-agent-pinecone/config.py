@@ -1,5 +1,7 @@
 """Configuration for Email Agent with Pinecone"""
 
+import os
+
 # AWS Region
 REGION = 'eu-central-1'
 
@@ -10,8 +12,15 @@ PINECONE_CONTENT_INDEX = 'email-content'
 
 # Reranking
 RERANK_MODEL = 'bge-reranker-v2-m3'
-INITIAL_RETRIEVAL_K = 20  # Get more candidates for reranking
+INITIAL_RETRIEVAL_K = 100  # Get more candidates for reranking
 FINAL_TOP_K = 5  # Return top results after reranking
+RERANK_CHUNK = 25  # Max documents per rerank call
+RERANK_MAX_WORKERS = 4  # Concurrent rerank calls per search
+RERANK_TEXT_FIELD = 'snippet'  # 'snippet' reranks on metadata, 'text' fetches the full embedded text
+RERANK_MAX_CHARS = 1024  # Truncate rerank documents to bound cross-encoder cost
+SKIP_RERANK_FOR_SHORT_SENDER = True  # Use vector order for one-word sender searches
+RERANK_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.rerank_cache.sqlite3')  # Local cache of (query, doc) rerank scores
+RERANK_CACHE_TTL = 900  # Seconds before cached rerank scores expire
 
 # Bedrock Models
 LLM_MODEL = 'eu.anthropic.claude-sonnet-4-20250514-v1:0'
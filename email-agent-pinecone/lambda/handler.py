@@ -5,8 +5,11 @@ Agent decides which tool to use based on the question.
 Uses LangChain 1.2.x create_agent (recommended approach).
 """
 
-import json
+import re
+from dataclasses import dataclass
+
 import boto3
+import orjson
 from mangum import Mangum
 from fastapi import FastAPI
 from fastapi.responses import StreamingResponse
@@ -26,9 +29,24 @@ DEFAULT_MODEL = os.environ.get('BEDROCK_MODEL_ID', 'eu.anthropic.claude-sonnet-4
 PINECONE_SECRET_NAME = 'pinecone-api-key'
 SENDERS_INDEX = 'email-senders'
 CONTENT_INDEX = 'email-content'
+TOKEN_RE = re.compile(r"\w+")  # Unicode-aware, so "Müller" stays one token
+
+# Fixed SSE events, pre-encoded once
+EV_THINKING = b'data: {"type":"status","message":"Thinking..."}\n\n'
+EV_DONE = b'data: {"type":"done"}\n\n'
 
 app = FastAPI()
 _pc_client = None
+_index_cache = {}
+
+
+@dataclass(slots=True)
+class Hit:
+    score: float
+    sender: str
+    subject: str
+    date_sent: str
+    snippet: str
 
 
 def get_pinecone_client():
@@ -40,46 +58,75 @@ def get_pinecone_client():
     return _pc_client
 
 
+def get_index(index_name: str):
+    index = _index_cache.get(index_name)
+    if index is None:
+        index = get_pinecone_client().Index(index_name)
+        _index_cache[index_name] = index
+    return index
+
+
+def tokenize(text: str) -> list:
+    """Casefolded word tokens, matching the *_tokens metadata written at upsert time"""
+    return TOKEN_RE.findall(text.casefold())
+
+
+def build_filter(year: int = None, sender_tokens: list = None, subject_tokens: list = None) -> dict:
+    """Build a Pinecone metadata filter from pre-tokenized values; every clause must match"""
+    clauses = []
+    if year:
+        clauses.append({"year": {"$eq": int(year)}})
+    if sender_tokens:
+        clauses.extend({"sender_tokens": {"$in": [t]}} for t in sender_tokens)
+    if subject_tokens:
+        clauses.extend({"subject_tokens": {"$in": [t]}} for t in subject_tokens)
+    
+    if not clauses:
+        return None
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$and": clauses}
+
+
 def search_index(index_name: str, query: str, top_k: int, year: int = None, 
                  sender_contains: str = None, subject_contains: str = None) -> list:
-    """Search a Pinecone index and return results with optional metadata filters"""
-    pc = get_pinecone_client()
-    index = pc.Index(index_name)
+    """Search a Pinecone index with optional metadata filters applied server-side.
+    
+    Filtering requires these metadata fields on each record at upsert time:
+        year: int, parsed from date_sent (e.g. 2026)
+        sender_tokens: list[str], tokenize(sender)
+        subject_tokens: list[str], tokenize(subject)
+    """
+    sender_tokens = tokenize(sender_contains) if sender_contains else None
+    subject_tokens = tokenize(subject_contains) if subject_contains else None
+    
+    # A filter value with no tokens can't match anything; never fall back to an unfiltered search
+    if (sender_contains and not sender_tokens) or (subject_contains and not subject_tokens):
+        return []
     
-    has_filters = year or sender_contains or subject_contains
-    fetch_k = top_k * 3 if has_filters else top_k
+    index = get_index(index_name)
+    
+    search_query = {"inputs": {"text": query}, "top_k": top_k}
+    filt = build_filter(year, sender_tokens, subject_tokens)
+    if filt:
+        search_query["filter"] = filt
     
     search_results = index.search(
         namespace="default",
-        query={"inputs": {"text": query}, "top_k": fetch_k},
+        query=search_query,
         fields=["message_id", "thread_id", "sender", "recipient", "subject", "date_sent", "snippet"]
     )
     
     docs = []
-    if search_results.get('result', {}).get('hits'):
-        for hit in search_results['result']['hits']:
-            fields = hit.get('fields', {})
-            date_sent = fields.get('date_sent', '')
-            sender = fields.get('sender', '')
-            subject = fields.get('subject', '')
-            
-            if year and str(year) not in date_sent:
-                continue
-            if sender_contains and sender_contains.lower() not in sender.lower():
-                continue
-            if subject_contains and subject_contains.lower() not in subject.lower():
-                continue
-            
-            docs.append({
-                "score": hit.get('_score', 0),
-                "sender": sender,
-                "subject": subject,
-                "date_sent": date_sent,
-                "snippet": fields.get('snippet', '')[:300]
-            })
-            
-            if len(docs) >= top_k:
-                break
+    for hit in search_results.get('result', {}).get('hits', []):
+        fields = hit.get('fields', {})
+        docs.append(Hit(
+            score=hit.get('_score', 0),
+            sender=fields.get('sender', ''),
+            subject=fields.get('subject', ''),
+            date_sent=fields.get('date_sent', ''),
+            snippet=fields.get('snippet', '')[:300]
+        ))
     
     return docs
 
@@ -88,16 +135,14 @@ def format_results(docs: list) -> str:
     if not docs:
         return "No emails found."
     
-    output = []
-    for doc in docs:
-        output.append(
-            f"Score: {doc['score']:.3f}\n"
-            f"From: {doc['sender']}\n"
-            f"Subject: {doc['subject']}\n"
-            f"Date: {doc['date_sent']}\n"
-            f"Preview: {doc['snippet']}"
-        )
-    return "\n\n---\n\n".join(output)
+    return "\n\n---\n\n".join(
+        f"Score: {doc.score:.3f}\n"
+        f"From: {doc.sender}\n"
+        f"Subject: {doc.subject}\n"
+        f"Date: {doc.date_sent}\n"
+        f"Preview: {doc.snippet}"
+        for doc in docs
+    )
 
 
 @tool
@@ -107,7 +152,7 @@ def search_by_sender(sender_name: str, year: int = None, subject_contains: str =
     Args:
         sender_name: Name of the sender to search for (e.g., 'Samant', 'Amazon', 'Google', 'Apple')
         year: Optional - filter by year (e.g., 2026, 2025, 2024)
-        subject_contains: Optional - filter by subject containing this text
+        subject_contains: Optional - filter by subject containing these whole words (e.g., 'invoice' does not match 'invoices')
         top_k: Number of results (default 20)
     """
     docs = search_index(SENDERS_INDEX, sender_name, top_k, year=year, subject_contains=subject_contains)
@@ -128,7 +173,7 @@ def search_by_content(query: str, year: int = None, sender_contains: str = None,
     Args:
         query: What to search for (e.g., 'flight booking', 'order confirmation', 'invoice', 'meeting')
         year: Optional - filter by year (e.g., 2026, 2025, 2024)
-        sender_contains: Optional - filter by sender containing this text
+        sender_contains: Optional - filter by sender containing these whole words (e.g., 'amazon', not 'amaz')
         top_k: Number of results (default 10)
     """
     docs = search_index(CONTENT_INDEX, query, top_k, year=year, sender_contains=sender_contains)
@@ -171,7 +216,7 @@ def get_agent(model_id: str):
 
 
 async def agent_stream(question: str, model: str, history: list = None):
-    yield f"data: {json.dumps({'type': 'status', 'message': 'Thinking...'})}\n\n"
+    yield EV_THINKING
     
     messages = []
     if history:
@@ -205,11 +250,11 @@ async def agent_stream(question: str, model: str, history: list = None):
             answer = "No response generated."
         
         # Send as token (frontend expects this)
-        yield f"data: {json.dumps({'type': 'token', 'content': answer})}\n\n"
-        yield f"data: {json.dumps({'type': 'done'})}\n\n"
+        yield b"data: " + orjson.dumps({'type': 'token', 'content': answer}) + b"\n\n"
+        yield EV_DONE
         
     except Exception as e:
-        yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+        yield b"data: " + orjson.dumps({'type': 'error', 'message': str(e)}) + b"\n\n"
 
 
 @app.post("/ask")
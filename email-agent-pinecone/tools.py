@@ -1,90 +1,264 @@
 """Tools for the Email Agent with Pinecone + Reranking"""
 
 import boto3
+import hashlib
 import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pinecone import Pinecone
 
 from config import (
     REGION, PINECONE_SECRET_NAME,
     PINECONE_SENDERS_INDEX, PINECONE_CONTENT_INDEX,
-    RERANK_MODEL, INITIAL_RETRIEVAL_K, FINAL_TOP_K
+    RERANK_MODEL, INITIAL_RETRIEVAL_K, FINAL_TOP_K,
+    RERANK_TEXT_FIELD, RERANK_MAX_CHARS, RERANK_CHUNK, RERANK_MAX_WORKERS,
+    RERANK_CACHE_PATH, RERANK_CACHE_TTL, SKIP_RERANK_FOR_SHORT_SENDER
 )
 
+SEARCH_FIELDS = ["message_id", "thread_id", "sender", "recipient", "subject", "date_sent", "snippet"]
+
 _pc_client = None
+_pc_client_lock = threading.Lock()
+_index_cache = {}
+
+
+class _RerankCache:
+    """SQLite cache of rerank scores keyed by (query hash, doc id)"""
+
+    def __init__(self, path: str, ttl: int):
+        self._ttl = ttl
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rerank_cache ("
+                "qhash TEXT, doc_id TEXT, score REAL, ts INTEGER, "
+                "PRIMARY KEY (qhash, doc_id))"
+            )
+            # Purge expired scores
+            self._conn.execute(
+                "DELETE FROM rerank_cache WHERE ts < ?",
+                (int(time.time()) - self._ttl,)
+            )
+
+    def get(self, qhash: str, doc_ids: list) -> dict:
+        """Return {doc_id: score} for cached, unexpired doc ids"""
+        if not doc_ids:
+            return {}
+        placeholders = ",".join("?" * len(doc_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT doc_id, score FROM rerank_cache "
+                f"WHERE qhash = ? AND ts >= ? AND doc_id IN ({placeholders})",
+                (qhash, int(time.time()) - self._ttl, *doc_ids)
+            ).fetchall()
+        return dict(rows)
+
+    def put(self, qhash: str, scores: dict):
+        """Store {doc_id: score} for a query hash"""
+        now = int(time.time())
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO rerank_cache (qhash, doc_id, score, ts) VALUES (?, ?, ?, ?)",
+                [(qhash, doc_id, score, now) for doc_id, score in scores.items()]
+            )
+
+
+_rerank_cache = None
+_rerank_cache_lock = threading.Lock()
+
+
+def get_rerank_cache():
+    """Open the rerank cache on first use rather than at import time"""
+    global _rerank_cache
+    with _rerank_cache_lock:
+        if _rerank_cache is None:
+            _rerank_cache = _RerankCache(RERANK_CACHE_PATH, RERANK_CACHE_TTL)
+    return _rerank_cache
 
 
 def get_pinecone_client():
     """Get Pinecone client with API key from Secrets Manager"""
     global _pc_client
-    if _pc_client is None:
-        secrets = boto3.client('secretsmanager', region_name=REGION)
-        api_key = secrets.get_secret_value(SecretId=PINECONE_SECRET_NAME)['SecretString']
-        _pc_client = Pinecone(api_key=api_key)
+    with _pc_client_lock:
+        if _pc_client is None:
+            secrets = boto3.client('secretsmanager', region_name=REGION)
+            api_key = secrets.get_secret_value(SecretId=PINECONE_SECRET_NAME)['SecretString']
+            _pc_client = Pinecone(api_key=api_key)
     return _pc_client
 
 
-def search_and_rerank(query: str, index_name: str, k: int = FINAL_TOP_K) -> list:
+def get_index(index_name: str):
+    """Get a cached Pinecone Index handle, reused across warm invocations"""
+    index = _index_cache.get(index_name)
+    if index is None:
+        index = get_pinecone_client().Index(index_name)
+        _index_cache[index_name] = index
+    return index
+
+
+def search_candidates(query: str, index_name: str, top_k: int = INITIAL_RETRIEVAL_K,
+                      include_full_text: bool = RERANK_TEXT_FIELD == 'text') -> list:
     """
-    Two-stage retrieval: vector search then rerank.
-    1. Get INITIAL_RETRIEVAL_K candidates from Pinecone
-    2. Rerank with bge-reranker-v2-m3
-    3. Return top k results
+    Stage 1: vector search with integrated embedding.
+    Returns candidate documents ready for reranking.
+    The large "text" field is only fetched when include_full_text is set;
+    otherwise rerank text is built from the metadata fields.
     """
-    pc = get_pinecone_client()
-    index = pc.Index(index_name)
+    index = get_index(index_name)
     
-    # Stage 1: Vector search with integrated embedding
     search_results = index.search(
         namespace="default",
-        query={"inputs": {"text": query}, "top_k": INITIAL_RETRIEVAL_K},
-        fields=["message_id", "thread_id", "sender", "recipient", "subject", "date_sent", "snippet", "text"]
+        query={"inputs": {"text": query}, "top_k": top_k},
+        fields=SEARCH_FIELDS + ["text"] if include_full_text else SEARCH_FIELDS
     )
     
-    if not search_results.get('result', {}).get('hits'):
-        return []
-    
-    hits = search_results['result']['hits']
-    
-    # Prepare documents for reranking
     documents = []
-    for hit in hits:
+    for hit in search_results.get('result', {}).get('hits', []):
         fields = hit.get('fields', {})
-        # Use the text field (what was embedded) for reranking
-        doc_text = fields.get('text', fields.get('subject', ''))
+        if include_full_text:
+            # Use the text field (what was embedded) for reranking
+            doc_text = fields.get('text', fields.get('subject', ''))
+        elif index_name == PINECONE_SENDERS_INDEX:
+            doc_text = fields.get('sender', '')
+        else:
+            doc_text = fields.get('subject', '') + " " + fields.get('snippet', '')
         documents.append({
             "id": hit['_id'],
-            "text": doc_text,
+            "index": index_name,
+            "text": doc_text[:RERANK_MAX_CHARS],
             "fields": fields,
             "original_score": hit.get('_score', 0)
         })
     
-    # Stage 2: Rerank
-    rerank_docs = [{"id": d["id"], "text": d["text"]} for d in documents]
+    return documents
+
+
+def search_only(query: str, index_name: str, k: int = FINAL_TOP_K) -> list:
+    """
+    Vector search without reranking, for lookups where vector order is already good.
+    Returns results in the same shape as rerank_docs, with the vector
+    score standing in for the rerank score.
+    """
+    return [
+        {
+            "id": d["id"],
+            "rerank_score": d["original_score"],
+            "original_score": d["original_score"],
+            "fields": d["fields"]
+        }
+        for d in search_candidates(query, index_name, k)
+    ]
+
+
+def rerank_docs(query: str, documents: list, k: int = FINAL_TOP_K) -> list:
+    """
+    Stage 2: rerank candidates with bge-reranker-v2-m3 and return the top k.
+    Cross-encoder scores are comparable across indexes, so candidates from
+    several indexes can be reranked together in one call.
+    Scores are cached per (query, index/doc id); only uncached documents are sent.
+    Results are de-duplicated by message id, keeping the highest score.
+    """
+    if not documents:
+        return []
+    
+    doc_by_key = {f"{d['index']}/{d['id']}": d for d in documents}
     
-    rerank_result = pc.inference.rerank(
-        model=RERANK_MODEL,
-        query=query,
-        documents=rerank_docs,
-        top_n=k,
-        return_documents=True
-    )
+    # Scores depend on the model and the rerank text, not just the query
+    cache_key = "\0".join([RERANK_MODEL, RERANK_TEXT_FIELD, str(RERANK_MAX_CHARS), query])
+    qhash = hashlib.sha1(cache_key.encode()).hexdigest()[:16]
+    cache = get_rerank_cache()
+    scores = cache.get(qhash, list(doc_by_key))
+    to_score = [key for key in doc_by_key if key not in scores]
     
-    # Merge rerank scores with original metadata
+    if to_score:
+        payload = [{"id": key, "text": doc_by_key[key]["text"]} for key in to_score]
+        chunks = [payload[i:i + RERANK_CHUNK] for i in range(0, len(payload), RERANK_CHUNK)]
+        
+        # Score every uncached candidate so later repeats can skip the call.
+        # Chunks bound the per-call payload and are reranked concurrently.
+        def rerank_chunk(chunk):
+            rerank_result = get_pinecone_client().inference.rerank(
+                model=RERANK_MODEL,
+                query=query,
+                documents=chunk,
+                top_n=len(chunk),
+                return_documents=True
+            )
+            return {item.document.id: item.score for item in rerank_result.data}
+        
+        new_scores = {}
+        with ThreadPoolExecutor(max_workers=min(len(chunks), RERANK_MAX_WORKERS)) as ex:
+            for chunk_scores in ex.map(rerank_chunk, chunks):
+                new_scores.update(chunk_scores)
+        
+        cache.put(qhash, new_scores)
+        scores.update(new_scores)
+    
+    # Merge top-k rerank scores with original metadata. A message found in
+    # several indexes keeps only its best-scoring entry.
     results = []
-    for item in rerank_result.data:
-        # Find original document with full metadata
-        orig_doc = next((d for d in documents if d["id"] == item.document.id), None)
-        if orig_doc:
-            results.append({
-                "id": item.document.id,
-                "rerank_score": item.score,
-                "original_score": orig_doc["original_score"],
-                "fields": orig_doc["fields"]
-            })
+    seen_ids = set()
+    for key, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        orig_doc = doc_by_key.get(key)
+        if not orig_doc or orig_doc["id"] in seen_ids:
+            continue
+        seen_ids.add(orig_doc["id"])
+        results.append({
+            "id": orig_doc["id"],
+            "index": orig_doc["index"],
+            "rerank_score": score,
+            "original_score": orig_doc["original_score"],
+            "fields": orig_doc["fields"]
+        })
+        if len(results) >= k:
+            break
     
     return results
 
 
+def search_and_rerank(query: str, index_name: str, k: int = FINAL_TOP_K) -> list:
+    """
+    Two-stage retrieval: vector search then rerank.
+    1. Get INITIAL_RETRIEVAL_K candidates from Pinecone
+    2. Rerank with bge-reranker-v2-m3 (scores cached per query/doc)
+    3. Return top k results
+    """
+    return rerank_docs(query, search_candidates(query, index_name), k)
+
+
+def search_and_rerank_indexes(query: str, search_type: str, k: int = FINAL_TOP_K) -> list:
+    """
+    Retrieve candidates from the indexes selected by search_type
+    and rerank them together in one call.
+    """
+    indexes = {}
+    if search_type in ["content", "both"]:
+        indexes["content"] = PINECONE_CONTENT_INDEX
+    if search_type in ["sender", "both"]:
+        indexes["sender"] = PINECONE_SENDERS_INDEX
+    
+    # Retrieve candidates from each index concurrently
+    with ThreadPoolExecutor(max_workers=max(len(indexes), 1)) as ex:
+        futs = {
+            source: ex.submit(search_candidates, query, index_name)
+            for source, index_name in indexes.items()
+        }
+    
+    # Rerank every candidate, including a message's entry from each index,
+    # so a sender-name match isn't lost to its content-text entry
+    documents = [d for fut in futs.values() for d in fut.result()]
+    source_by_index = {index_name: source for source, index_name in indexes.items()}
+    
+    all_results = rerank_docs(query, documents, k)
+    for r in all_results:
+        r["source"] = source_by_index[r["index"]]
+    
+    return all_results
+
+
 def semantic_search(query: str, k: int = FINAL_TOP_K, search_type: str = "content") -> str:
     """
     Search emails using Pinecone with reranking.
@@ -97,23 +271,13 @@ def semantic_search(query: str, k: int = FINAL_TOP_K, search_type: str = "conten
     Returns:
         Formatted string with matching emails
     """
-    all_results = []
-    
-    if search_type in ["content", "both"]:
-        content_results = search_and_rerank(query, PINECONE_CONTENT_INDEX, k)
-        for r in content_results:
-            r["source"] = "content"
-        all_results.extend(content_results)
-    
-    if search_type in ["sender", "both"]:
-        sender_results = search_and_rerank(query, PINECONE_SENDERS_INDEX, k)
-        for r in sender_results:
+    # Cross-encoder adds little for one-word sender lookups; vector order is as good
+    if SKIP_RERANK_FOR_SHORT_SENDER and search_type == "sender" and len(query.strip().split()) <= 1:
+        all_results = search_only(query, PINECONE_SENDERS_INDEX, k)
+        for r in all_results:
             r["source"] = "sender"
-        all_results.extend(sender_results)
-    
-    # Sort by rerank score and take top k
-    all_results.sort(key=lambda x: x["rerank_score"], reverse=True)
-    all_results = all_results[:k]
+    else:
+        all_results = search_and_rerank_indexes(query, search_type, k)
     
     if not all_results:
         return "No matching emails found."
@@ -139,6 +303,7 @@ def search_by_sender(sender_query: str, k: int = FINAL_TOP_K) -> str:
     """
     Search emails by sender name/email.
     Uses the email-senders index which embeds sender field.
+    Email addresses and quoted names skip reranking.
     
     Args:
         sender_query: Name or email to search for (e.g., "Amazon", "john@example.com")
@@ -147,7 +312,12 @@ def search_by_sender(sender_query: str, k: int = FINAL_TOP_K) -> str:
     Returns:
         Formatted string with matching emails
     """
-    results = search_and_rerank(sender_query, PINECONE_SENDERS_INDEX, k)
+    # Exact addresses and quoted names don't benefit from the cross-encoder
+    is_quoted = len(sender_query) > 1 and sender_query.startswith('"') and sender_query.endswith('"')
+    if "@" in sender_query or is_quoted:
+        results = search_only(sender_query.strip('"'), PINECONE_SENDERS_INDEX, k)
+    else:
+        results = search_and_rerank(sender_query, PINECONE_SENDERS_INDEX, k)
     
     if not results:
         return f"No emails found from sender matching '{sender_query}'."
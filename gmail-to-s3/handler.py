@@ -4,14 +4,21 @@ Handles 30K+ emails with checkpointing and automatic recovery
 """
 
 import os
-import json
+import io
+import gzip
 import time
+import random
+import threading
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+import orjson
+from httplib2 import Http, HttpLib2Error
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from google.auth.exceptions import RefreshError, TransportError
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from aws_durable_execution_sdk_python import DurableContext, durable_execution
@@ -23,13 +30,34 @@ SECRETS_NAME = os.environ.get('GMAIL_TOKEN_SECRET', 'gmail-oauth-token')
 S3_BUCKET = os.environ['S3_BUCKET']
 S3_PREFIX = os.environ.get('S3_PREFIX', 'gmail-exports')
 PROGRESS_KEY = f"{S3_PREFIX}/progress.json"
+GMAIL_BATCH_LIMIT = 50  # Requests per Gmail batch; Google rate-limits batches larger than 50
+HTTP_TIMEOUT = 60  # Seconds, googleapiclient's default; full-format batch responses are large
+PROGRESS_MIN_INTERVAL = 10.0  # Seconds between RUNNING progress writes
+
+_s3 = None
+_s3_lock = threading.Lock()
+_tls = threading.local()
+_fetch_executor = None
+_fetch_executor_workers = 0
+_fetch_executor_lock = threading.Lock()
+_last_progress_ts = 0.0
+
+
+def s3_client():
+    """Shared S3 client, created once per Lambda worker (boto3 clients are thread-safe)"""
+    global _s3
+    if _s3 is None:
+        with _s3_lock:
+            if _s3 is None:
+                _s3 = boto3.client('s3')
+    return _s3
 
 
 def get_gmail_credentials():
     """Retrieve Gmail OAuth credentials from Secrets Manager"""
     secrets_client = boto3.client('secretsmanager')
     response = secrets_client.get_secret_value(SecretId=SECRETS_NAME)
-    token_data = json.loads(response['SecretString'])
+    token_data = orjson.loads(response['SecretString'])
     
     creds = Credentials(
         token=token_data['token'],
@@ -52,14 +80,40 @@ def get_gmail_credentials():
         }
         secrets_client.put_secret_value(
             SecretId=SECRETS_NAME,
-            SecretString=json.dumps(new_token_data)
+            SecretString=orjson.dumps(new_token_data).decode()
         )
     
     return creds
 
 
+def get_fetch_executor(workers):
+    """Long-lived Gmail fetch pool, so worker threads (and their cached services and
+    connections) survive across steps and warm invocations instead of dying per batch
+    """
+    global _fetch_executor, _fetch_executor_workers
+    with _fetch_executor_lock:
+        if _fetch_executor is None or _fetch_executor_workers != workers:
+            if _fetch_executor is not None:
+                _fetch_executor.shutdown(wait=False)
+            _fetch_executor = ThreadPoolExecutor(max_workers=workers)
+            _fetch_executor_workers = workers
+    return _fetch_executor
+
+
 def get_gmail_service():
-    return build('gmail', 'v1', credentials=get_gmail_credentials())
+    """Per-thread Gmail service, since googleapiclient service and httplib2 objects are not thread-safe.
+    Each thread keeps one authorized HTTP transport so TCP/TLS connections are reused across calls.
+    """
+    if not hasattr(_tls, 'service'):
+        authed = AuthorizedHttp(get_gmail_credentials(), http=Http(timeout=HTTP_TIMEOUT))
+        _tls.service = build('gmail', 'v1', http=authed, cache_discovery=False)
+    return _tls.service
+
+
+def reset_gmail_service():
+    """Drop this thread's cached service so the next call re-reads the secret
+    (e.g. after the refresh token was revoked and replaced via setup_token.py)"""
+    _tls.__dict__.pop('service', None)
 
 
 def update_progress(s3, processed, total_found, status, timestamp):
@@ -75,27 +129,67 @@ def update_progress(s3, processed, total_found, status, timestamp):
     s3.put_object(
         Bucket=S3_BUCKET,
         Key=PROGRESS_KEY,
-        Body=json.dumps(progress, indent=2),
+        Body=orjson.dumps(progress, option=orjson.OPT_INDENT_2),
         ContentType='application/json'
     )
 
 
-def fetch_email_with_retry(service, msg_id, max_retries=3):
-    """Fetch email with exponential backoff for rate limits"""
+def maybe_update_progress(s3, processed, total_found, status, timestamp,
+                          min_interval=PROGRESS_MIN_INTERVAL, force=False):
+    """Update progress, skipping RUNNING writes within min_interval of the last one unless forced"""
+    global _last_progress_ts
+    now = time.time()
+    if not force and status == 'RUNNING' and (now - _last_progress_ts) < min_interval:
+        return
+    _last_progress_ts = now
+    update_progress(s3, processed, total_found, status, timestamp)
+
+
+def fetch_emails_batch(service, msg_ids, max_retries=6):
+    """Fetch up to GMAIL_BATCH_LIMIT emails in one batch HTTP request with jittered exponential backoff.
+    Retries rate-limited/server-error sub-requests, and the whole batch on transient failures.
+    Returns (emails, failed_ids), where failed_ids had non-retryable errors (e.g. deleted messages).
+    Raises if any message is still unresolved after max_retries, so the durable step is retried
+    instead of checkpointing a partial batch.
+    """
+    emails = []
+    failed = []
+    resolved = set()
+    pending = list(msg_ids)
+    
     for attempt in range(max_retries):
+        def callback(request_id, response, exception):
+            if exception is None:
+                emails.append(response)
+                resolved.add(request_id)
+            elif not (isinstance(exception, HttpError) and exception.resp.status in [429, 500, 503]):
+                failed.append(request_id)
+                resolved.add(request_id)
+        
+        batch = service.new_batch_http_request(callback=callback)
+        for msg_id in pending:
+            batch.add(
+                service.users().messages().get(userId='me', id=msg_id, format='full'),
+                request_id=msg_id
+            )
         try:
-            return service.users().messages().get(
-                userId='me',
-                id=msg_id,
-                format='full'
-            ).execute()
+            batch.execute()
         except HttpError as e:
-            if e.resp.status in [429, 500, 503]:  # Rate limit or server errors
-                wait_time = (2 ** attempt) + 1  # 2, 3, 5 seconds
-                time.sleep(wait_time)
-                continue
-            raise
-    return None
+            if e.resp.status not in [429, 500, 503]:  # Rate limit or server errors
+                raise
+        except (OSError, HttpLib2Error, TransportError):
+            pass  # Socket timeout or connection failure
+        
+        # Anything without a final outcome (retryable error or failed batch) goes again
+        pending = [msg_id for msg_id in pending if msg_id not in resolved]
+        if not pending:
+            break
+        if attempt < max_retries - 1:
+            time.sleep((2 ** attempt) * random.uniform(0.5, 1.5))  # ~1, 2, 4, 8, 16 seconds
+    
+    if pending:
+        raise RuntimeError(f"{len(pending)} Gmail messages still unresolved after {max_retries} attempts")
+    return emails, failed
 
 
 @durable_step
@@ -103,12 +197,16 @@ def fetch_page_step(step_context: StepContext, query: str, page_token: str) -> d
     """Fetch one page of message IDs"""
     service = get_gmail_service()
     
-    results = service.users().messages().list(
-        userId='me',
-        q=query if query else None,
-        maxResults=500,  # Max allowed by Gmail API
-        pageToken=page_token if page_token else None
-    ).execute()
+    try:
+        results = service.users().messages().list(
+            userId='me',
+            q=query if query else None,
+            maxResults=500,  # Max allowed by Gmail API
+            pageToken=page_token if page_token else None
+        ).execute()
+    except RefreshError:
+        reset_gmail_service()
+        raise
     
     messages = results.get('messages', [])
     message_ids = [msg['id'] for msg in messages]
@@ -119,37 +217,51 @@ def fetch_page_step(step_context: StepContext, query: str, page_token: str) -> d
 
 
 @durable_step
-def process_batch_step(step_context: StepContext, batch_ids: list, timestamp: str, workers: int) -> int:
-    """Process batch in parallel - raw upload only (no decoding)"""
+def process_batch_step(step_context: StepContext, batch_ids: list, timestamp: str, workers: int, batch_name: str) -> int:
+    """Fetch batch via Gmail batch requests and upload as one gzipped NDJSON object (raw, no decoding)"""
     
-    def process_one(msg_id):
+    def fetch_chunk(chunk_ids):
         service = get_gmail_service()
-        s3 = boto3.client('s3')
-        
-        email = fetch_email_with_retry(service, msg_id)
-        if not email:
-            return 0
-        
-        # Upload raw only
-        key = f"{S3_PREFIX}/raw/{timestamp}/email_{msg_id}.json"
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=key,
-            Body=json.dumps(email),
-            ContentType='application/json'
-        )
-        return 1
+        try:
+            return fetch_emails_batch(service, chunk_ids)
+        except RefreshError:
+            reset_gmail_service()
+            raise
+    
+    chunks = [batch_ids[i:i + GMAIL_BATCH_LIMIT] for i in range(0, len(batch_ids), GMAIL_BATCH_LIMIT)]
+    
+    emails = []
+    dropped = []
+    # Threads are only started as chunks need them, and are reused by later batches.
+    # A chunk that fails outright fails the step, so the durable runtime retries the batch.
+    executor = get_fetch_executor(workers)
+    futures = [executor.submit(fetch_chunk, chunk) for chunk in chunks]
+    for future in as_completed(futures):
+        chunk_emails, failed_ids = future.result()
+        emails.extend(chunk_emails)
+        dropped.extend(failed_ids)
+    
+    if dropped:
+        step_context.logger.warning(f"Dropped {len(dropped)} messages in {batch_name}: {dropped}")
+    
+    if not emails:
+        return 0
     
-    processed = 0
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = [executor.submit(process_one, msg_id) for msg_id in batch_ids]
-        for future in as_completed(futures):
-            try:
-                processed += future.result()
-            except Exception:
-                pass
+    # One email per line, single PUT per batch
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+        for email in emails:
+            gz.write(orjson.dumps(email) + b'\n')
     
-    return processed
+    s3_client().put_object(
+        Bucket=S3_BUCKET,
+        Key=f"{S3_PREFIX}/raw/{timestamp}/{batch_name}.ndjson.gz",
+        Body=buf.getvalue(),
+        ContentType='application/x-ndjson',
+        ContentEncoding='gzip'
+    )
+    
+    return len(emails)
 
 
 @durable_execution
@@ -160,18 +272,23 @@ def handler(event, context: DurableContext) -> dict:
     max_emails = event.get('max_emails', 0)
     workers = event.get('workers', 20)
     batch_size = event.get('batch_size', 200)
+    # workers caps concurrent Gmail batch requests; a batch never has more than
+    # ceil(batch_size / GMAIL_BATCH_LIMIT) of them, so don't hold threads beyond that
+    workers = max(1, min(workers, -(-batch_size // GMAIL_BATCH_LIMIT)))
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     
-    s3 = boto3.client('s3')
+    s3 = s3_client()
     total_processed = 0
     total_found = 0
-    page_token = ''
     
-    update_progress(s3, 0, 0, 'RUNNING', timestamp)
+    # Always write the first update; the throttle timestamp survives warm container reuse
+    maybe_update_progress(s3, 0, 0, 'RUNNING', timestamp, force=True)
+    
+    # Fetch first page of IDs (up to 500)
+    page_num = 0
+    page_result = context.step(fetch_page_step(query, ''), name='fetch_page_0')
     
     while True:
-        # Fetch page of IDs (up to 500)
-        page_result = context.step(fetch_page_step(query, page_token))
         message_ids = page_result['ids']
         page_token = page_result['next_token']
         
@@ -179,21 +296,37 @@ def handler(event, context: DurableContext) -> dict:
             break
         
         total_found += len(message_ids)
+        page_num += 1
         
-        # Process in batches
-        for i in range(0, len(message_ids), batch_size):
-            batch = message_ids[i:i + batch_size]
-            processed = context.step(process_batch_step(batch, timestamp, workers))
-            total_processed += processed
-            
-            # Update progress after each batch
-            update_progress(s3, total_processed, total_found, 'RUNNING', timestamp)
-            context.logger.info(f"Progress: {total_processed}/{total_found}")
+        def process_page(page_context: DurableContext, message_ids=message_ids, page_num=page_num) -> int:
+            """Process the current page in batches"""
+            page_processed = 0
+            for i in range(0, len(message_ids), batch_size):
+                batch = message_ids[i:i + batch_size]
+                batch_name = f"batch_{page_num:04d}_{i // batch_size:03d}"
+                page_processed += page_context.step(process_batch_step(batch, timestamp, workers, batch_name))
+                
+                # Update progress after each batch (throttled)
+                maybe_update_progress(s3, total_processed + page_processed, total_found, 'RUNNING', timestamp)
+                page_context.logger.info(f"Progress: {total_processed + page_processed}/{total_found}")
+            return page_processed
+        
+        def prefetch_next_page(page_context: DurableContext, page_token=page_token, page_num=page_num) -> dict:
+            """Fetch the next page of IDs while the current page is processed"""
+            return page_context.step(fetch_page_step(query, page_token), name=f'fetch_page_{page_num}')
+        
+        branches = [process_page, prefetch_next_page] if page_token else [process_page]
+        page_results = context.parallel(branches, name=f'page_{page_num}')
+        page_results.throw_if_error()
+        
+        total_processed += page_results.all[0].result
         
         if max_emails and total_processed >= max_emails:
             break
         if not page_token:
             break
+        
+        page_result = page_results.all[1].result
     
     update_progress(s3, total_processed, total_found, 'COMPLETE', timestamp)
     